@@ -1,68 +1,286 @@
+import asyncio
+import atexit
+import httpx
+import json
 import openai
 import os
+import sqlite3
+import sys
+import time
+import zstandard as zstd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 from dotenv import load_dotenv
 import streamlit as st
-import json
 from streamlit_feedback import streamlit_feedback
-# Load environment variables
-env_path = os.path.join('.env')
-load_dotenv(env_path)
 
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+@st.cache_resource
+def get_client():
+    """Build the OpenAI client once per Streamlit process.
+
+    Async so the interpreter is free between chunks, with a tuned
+    connection pool so keep-alive connections are reused instead of
+    renegotiating TLS per request. cache_resource means .env parsing,
+    secrets lookup, and pool construction don't repeat on every rerun.
+    """
+    load_dotenv(os.path.join('.env'))
+    return openai.AsyncOpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
+    )
+
+@st.cache_resource
+def get_io_loop():
+    """Run one process-wide event loop on a dedicated thread.
+
+    All OpenAI I/O happens on this loop so the cached client's
+    keep-alive sockets are only ever touched by the loop that created
+    them — per-session loops would pull pooled connections bound to
+    another session's loop. Script threads submit coroutines via
+    asyncio.run_coroutine_threadsafe.
+    """
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True, name="openai-io").start()
+    return loop
+
 
+def render_sidebar():
+    """Render sidebar controls; values are read back via st.session_state keys"""
+    st.sidebar.selectbox("Choose the model",["gpt-3.5","gpt-3.5-turbo","gpt-4o"],index=1,key="model_name")
+    st.sidebar.slider("Set Temperature", min_value=0.0,max_value=1.0,value=0.7,step=0.1,key="temperature")
+    st.sidebar.number_input("Max History Length",min_value=1,max_value=10,value=3,key="max_history_length")
 
-#Sidebar controls for model and temperature 
-model_name = st.sidebar.selectbox("Choose the model",["gpt-3.5","gpt-3.5-turbo","gpt-4o"],index=1)
-temperature = st.sidebar.slider("Set Temperature", min_value=0.0,max_value=1.0,value=0.7,step=0.1) 
-MAX_HISTORY_LENGTH = int(st.sidebar.number_input("Max History Length",min_value=1,max_value=10,value=3))
-def save_chat_history(chat_history):
-    """Save chat history to a file"""
+@st.cache_resource
+def get_db():
+    """Open the SQLite connection once per Streamlit process"""
+    conn = sqlite3.connect('chat.db', isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages"
+        "(id INTEGER PRIMARY KEY, role TEXT, content TEXT, ts REAL)"
+    )
+    return conn
+
+# Single writer thread so persistence never blocks the UI turn; the
+# atexit shutdown waits so the final write isn't lost on exit
+_save_executor = ThreadPoolExecutor(max_workers=1)
+atexit.register(_save_executor.shutdown, wait=True)
+
+# Compress message bodies above this size before insert; short messages
+# aren't worth the zstd frame overhead
+_COMPRESS_MIN_BYTES = 512
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_compressor = zstd.ZstdCompressor(level=3)
+
+def _pack_content(text):
+    """Encode a message body, zstd-compressing it if it's large (writer thread)"""
+    raw = text.encode()
+    if len(raw) >= _COMPRESS_MIN_BYTES:
+        return _compressor.compress(raw)
+    return raw
+
+def _unpack_content(value):
+    """Decode a stored message body, handling compressed and legacy plain rows"""
+    if isinstance(value, bytes):
+        if value.startswith(_ZSTD_MAGIC):
+            value = zstd.ZstdDecompressor().decompress(value)
+        return value.decode()
+    return value
+
+def _insert_message(message):
+    """Insert a single message row (runs on the writer thread)"""
     try:
-        with open('chat_history.json', 'w') as f:
-            json.dump(chat_history, f)
+        get_db().execute(
+            "INSERT INTO messages VALUES(NULL,?,?,?)",
+            (message["role"], _pack_content(message["content"]), time.time())
+        )
     except Exception as e:
-        st.error(f"Error saving chat history: {str(e)}")
+        print(f"Error saving chat history: {str(e)}", file=sys.stderr)
+
+def append_message(message):
+    """Queue a message for the background writer thread"""
+    _save_executor.submit(_insert_message, dict(message))
 
 def load_chat_history():
-    """Load chat history from file"""
+    """Load the most recent messages from the chat database"""
     try:
-        if os.path.exists('chat_history.json'):
-            with open('chat_history.json', 'r') as f:
-                return json.load(f)
+        rows = get_db().execute(
+            "SELECT role, content FROM messages ORDER BY id DESC LIMIT ?",
+            (st.session_state.max_history_length * 2,)
+        ).fetchall()
+        return [{"role": role, "content": _unpack_content(content)} for role, content in reversed(rows)]
     except Exception as e:
         st.error(f"Error loading chat history: {str(e)}")
     return []
 
-def stream_chat_response(message, chat_history):
-    """Stream the chat response from OpenAI API"""
-    stream = client.chat.completions.create(
-        messages=chat_history,
-        model=model_name,
+def clear_chat_log():
+    """Delete all persisted messages"""
+    try:
+        get_db().execute("DELETE FROM messages")
+    except Exception as e:
+        st.error(f"Error clearing chat history: {str(e)}")
+
+async def stream_chat_response(message, chat_history, model, temperature):
+    """Stream the chat response from OpenAI API.
+
+    Runs on the shared I/O loop thread, which has no ScriptRunContext,
+    so widget values must be passed in rather than read from
+    st.session_state here.
+    """
+    # Snapshot the sliding window into a tuple — the deque is already
+    # capped at the send window, and an immutable copy can't be mutated
+    # under us while the stream is in flight
+    messages = tuple(chat_history)
+    async with get_client().chat.completions.stream(
+        messages=messages,
+        model=model,
         temperature=temperature,
-        stream=True
-    )
-    
-    for chunk in stream:
-        if chunk.choices[0].delta.content:
-            yield chunk.choices[0].delta.content
+    ) as stream:
+        # The helper hands us typed events, so content deltas arrive
+        # pre-extracted instead of via a choices/delta walk per chunk,
+        # and the connection is released promptly if the consumer stops
+        async for event in stream:
+            if event.type == "content.delta":
+                yield event.delta
+
+async def fan_out(prompts, models, temperature=0.7, max_concurrency=8):
+    """Dispatch several chat completions concurrently.
+
+    For batched paths (regenerate, compare-two-models, evals): requests
+    overlap their network waits under a semaphore cap, so N calls finish
+    in roughly the slowest one's latency instead of their sum. Like
+    stream_chat_response, this runs on the shared I/O loop thread, so
+    callers pass widget values in instead of it reading st.session_state.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    client = get_client()
+
+    async def one(messages, model):
+        async with sem:
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            )
+
+    return await asyncio.gather(*[one(p, m) for p, m in zip(prompts, models)])
 
 def initialize_session_state():
     """Initialize or restore session state"""
+    window = st.session_state.max_history_length * 2
     if 'chat_history' not in st.session_state:
-        # Try to load previous chat history
-        st.session_state.chat_history = load_chat_history()
-    
+        # Try to load previous chat history; the deque maxlen keeps
+        # in-memory history capped at the window without slice copies
+        st.session_state.chat_history = deque(load_chat_history(), maxlen=window)
+    elif st.session_state.chat_history.maxlen != window:
+        # Sidebar window changed — rebuild with the new bound
+        st.session_state.chat_history = deque(st.session_state.chat_history, maxlen=window)
+
+    if 'turn_count' not in st.session_state:
+        st.session_state.turn_count = 0
+
     if 'is_initialized' not in st.session_state:
         st.session_state.is_initialized = True
 
+def _log_feedback(turn, value):
+    """Append pruned feedback to a JSONL log before it's dropped from memory"""
+    try:
+        with open('feedback_log.jsonl', 'a') as f:
+            f.write(json.dumps({"turn": turn, "feedback": value}) + '\n')
+    except Exception as e:
+        print(f"Error logging feedback: {str(e)}", file=sys.stderr)
+
+def prune_feedback_state():
+    """Drop feedback widget state older than the history window.
+
+    Feedback keys otherwise accumulate in st.session_state for every
+    turn of the session; this caps them at O(window) and persists any
+    pruned responses to the feedback log.
+    """
+    cutoff = st.session_state.turn_count - st.session_state.max_history_length * 2
+    for key in [k for k in st.session_state.keys() if k.startswith('feedback_')]:
+        turn = int(key.rsplit('_', 1)[1])
+        if turn < cutoff:
+            value = st.session_state.pop(key)
+            if value is not None:
+                _log_feedback(turn, value)
+
 def clear_chat():
     """Clear chat history and rerun the app"""
-    st.session_state.chat_history = []
-    save_chat_history([])
+    st.session_state.chat_history = deque(maxlen=st.session_state.max_history_length * 2)
+    clear_chat_log()
     st.rerun()
 
+@st.fragment
+def render_transcript():
+    """Render the stored transcript in its own fragment"""
+    for message in st.session_state.chat_history:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
+
+@st.fragment
+def stream_turn(user_input):
+    """Run one user turn; fragment-scoped so streaming doesn't re-render history"""
+    # Add user message to history
+    st.session_state.chat_history.append({
+        "role": "user",
+        "content": user_input
+    })
+    append_message({"role": "user", "content": user_input})
+
+    # Display user message
+    with st.chat_message("user"):
+        st.write(user_input)
+
+    # Generate and display assistant response
+    with st.chat_message("assistant"):
+        # st.write_stream appends deltas and batches frames internally,
+        # so no hand-rolled accumulator/coalescing is needed; bridge the
+        # async generator from the shared I/O loop chunk by chunk
+        def _sync_chunks():
+            loop = get_io_loop()
+            # Snapshot widget values here on the script thread — the
+            # coroutine can't read st.session_state from the I/O loop
+            agen = stream_chat_response(
+                user_input,
+                st.session_state.chat_history,
+                st.session_state.model_name,
+                st.session_state.temperature,
+            )
+            try:
+                while True:
+                    try:
+                        yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+                    except StopAsyncIteration:
+                        break
+            finally:
+                asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+        full_response = st.write_stream(_sync_chunks())
+
+        # Add assistant response to history
+        st.session_state.chat_history.append({
+            "role": "assistant",
+            "content": full_response
+        })
+        append_message({"role": "assistant", "content": full_response})
+        st.session_state.turn_count += 1
+
+@st.fragment
+def render_feedback():
+    """Feedback for the latest assistant reply; thumb clicks rerun only this fragment"""
+    if st.session_state.chat_history and st.session_state.chat_history[-1]["role"] == "assistant":
+        feedback=streamlit_feedback(feedback_type="thumbs",optional_text_label="[Optional] Please provide an explanation",key=f"feedback_{st.session_state.turn_count}",)
+
 def main():
+    # Sidebar controls for model and temperature
+    render_sidebar()
+
     # Initialize session state
     initialize_session_state()
     
@@ -82,48 +300,16 @@ def main():
         clear_chat()
     
     # Display chat history
-    for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
-    
+    render_transcript()
+
     # User input
     user_input = st.chat_input("Type your message here...")
-    
+
     if user_input:
-        # Add user message to history
-        st.session_state.chat_history.append({
-            "role": "user", 
-            "content": user_input
-        })
-        
-        # Display user message
-        with st.chat_message("user"):
-            st.write(user_input)
-        
-        # Generate and display assistant response
-        with st.chat_message("assistant"):
-            response_placeholder = st.empty()
-            full_response = ""
-            
-            # Stream the response
-            for chunk in stream_chat_response(user_input, st.session_state.chat_history):
-                full_response += chunk
-                response_placeholder.write(full_response)
-            
-            # Add assistant response to history
-            st.session_state.chat_history.append({
-                "role": "assistant", 
-                "content": full_response
-            })
-            
-            feedback=streamlit_feedback(feedback_type="thumbs",optional_text_label="[Optional] Please provide an explanation",key=f"feedback_{len(st.session_state.chat_history)}",)
-            # Save updated chat history
-            save_chat_history(st.session_state.chat_history)
-            
-            # Trim history if it gets too long
-            if len(st.session_state.chat_history) > MAX_HISTORY_LENGTH * 2:
-                st.session_state.chat_history = st.session_state.chat_history[-MAX_HISTORY_LENGTH*2:]
-                save_chat_history(st.session_state.chat_history)
+        stream_turn(user_input)
+
+    render_feedback()
+    prune_feedback_state()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file